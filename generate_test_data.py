@@ -1,66 +1,242 @@
+import io
 import os
-import random
+import sys
 import hashlib
+import concurrent.futures
+import multiprocessing
+import numpy as np
 from datetime import datetime
+from pathlib import Path
+from PIL import Image
+
+# Numba可用时走融合内核快速路径，不可用时退回纯NumPy实现
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# 装有dgen_wafer（Rust/PyO3加速扩展，独立打包）时整个晶圆
+# 直接由原生代码生成，Python侧只负责任务分发
+try:
+    import dgen_wafer
+except ImportError:
+    dgen_wafer = None
+
+# 模块级随机数生成器（PCG64），供矢量化噪点生成使用
+_rng = np.random.default_rng()
+
+# PNG编码（zlib会释放GIL）和磁盘写入用小线程池重叠执行
+_io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+def _make_disk_mask(r):
+    yy, xx = np.ogrid[-r:r + 1, -r:r + 1]
+    return xx * xx + yy * yy <= r * r
+
+# 缺陷半径固定在5-20，只有16种圆形蒙版，模块加载时全部预生成
+_disk_masks = {r: _make_disk_mask(r) for r in range(5, 21)}
+
+def _disk_mask(r):
+    mask = _disk_masks.get(r)
+    if mask is None:
+        mask = _disk_masks[r] = _make_disk_mask(r)
+    return mask
+
+# 按图像尺寸复用的噪点缓冲区（每个进程一份），避免每张图重新分配
+# Generator.integers没有out=参数，这里用random(out=...)填充浮点缓冲区
+# 再乘以范围、带转换地写入整型缓冲区
+_noise_bufs = {}
+
+def _noise_buffers(noise_count):
+    bufs = _noise_bufs.get(noise_count)
+    if bufs is None:
+        bufs = _noise_bufs[noise_count] = (
+            np.empty((noise_count, 3)),   # 颜色（浮点，赋值时截断为uint8）
+            np.empty(noise_count),        # 坐标采样
+            np.empty(noise_count, np.intp),
+            np.empty(noise_count, np.intp),
+        )
+    return bufs
+
+# 生成背景+噪点的图像缓冲区
+def make_base(width=600, height=400):
+    # 创建一个随机背景色的图像缓冲区
+    bg_color = _rng.integers(200, 256, 3)
+    bg = np.full((height, width, 3), bg_color, dtype=np.uint8)
+
+    # 添加随机噪点（一次性生成全部坐标和颜色，避免逐像素循环）
+    noise_count = width * height // 10
+    colors, coords, xs, ys = _noise_buffers(noise_count)
+    _rng.random(out=colors)
+    np.multiply(colors, 256, out=colors)
+    _rng.random(out=coords)
+    np.multiply(coords, width, out=xs, casting='unsafe')
+    _rng.random(out=coords)
+    np.multiply(coords, height, out=ys, casting='unsafe')
+    bg[ys, xs] = colors
+    return bg
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _fill_image(out, bg_color, defects, seed):
+        """单趟填充背景+噪点+缺陷，按行并行。
+
+        defects为(k,6)整型数组：cx, cy, 半径, r, g, b。
+        噪点用每行独立的xorshift64状态生成，行状态由seed经
+        splitmix64常数混合行号派生，同一seed重复调用结果一致。
+        """
+        height = out.shape[0]
+        width = out.shape[1]
+        noise_per_row = width // 10
+        for y in numba.prange(height):
+            s = np.uint64(seed) ^ (np.uint64(y + 1) * np.uint64(0x9E3779B97F4A7C15))
+            if s == np.uint64(0):
+                s = np.uint64(0x9E3779B97F4A7C15)
+            for x in range(width):
+                out[y, x, 0] = bg_color[0]
+                out[y, x, 1] = bg_color[1]
+                out[y, x, 2] = bg_color[2]
+            for _ in range(noise_per_row):
+                s ^= s << np.uint64(13)
+                s ^= s >> np.uint64(7)
+                s ^= s << np.uint64(17)
+                x = int(s % np.uint64(width))
+                out[y, x, 0] = np.uint8(s >> np.uint64(16))
+                out[y, x, 1] = np.uint8(s >> np.uint64(24))
+                out[y, x, 2] = np.uint8(s >> np.uint64(32))
+            for d in range(defects.shape[0]):
+                dy = y - defects[d, 1]
+                r = defects[d, 2]
+                if dy * dy <= r * r:
+                    half = int(np.sqrt(float(r * r - dy * dy)))
+                    for x in range(defects[d, 0] - half, defects[d, 0] + half + 1):
+                        if 0 <= x < width:
+                            out[y, x, 0] = np.uint8(defects[d, 3])
+                            out[y, x, 1] = np.uint8(defects[d, 4])
+                            out[y, x, 2] = np.uint8(defects[d, 5])
+else:
+    _fill_image = None
+
+# 采样一组缺陷参数，供融合内核使用
+def _sample_defects(width=600, height=400):
+    k = int(_rng.integers(1, 6))
+    defects = np.empty((k, 6), np.int64)
+    defects[:, 0] = _rng.integers(50, width - 49, k)
+    defects[:, 1] = _rng.integers(50, height - 49, k)
+    defects[:, 2] = _rng.integers(5, 21, k)
+    defects[:, 3:6] = _rng.integers(0, 101, (k, 3))
+    return defects
+
+# 在缓冲区上叠加模拟缺陷点
+def stamp_defects(bg):
+    height, width = bg.shape[:2]
+    # 添加模拟缺陷点（1-5个），用缓存的圆形蒙版直接写入缓冲区
+    for _ in range(int(_rng.integers(1, 6))):
+        x = int(_rng.integers(50, width - 49))
+        y = int(_rng.integers(50, height - 49))
+        size = int(_rng.integers(5, 21))
+        color = _rng.integers(0, 101, 3, dtype=np.uint8)
+        bg[y - size:y + size + 1, x - size:x + size + 1][_disk_mask(size)] = color
+
+    return bg
 
 # 生成随机图像数据的函数
 def generate_random_image(width=600, height=400):
-    from PIL import Image, ImageDraw
-    
-    # 创建一个随机背景色的图像
-    img = Image.new('RGB', (width, height), 
-                   (random.randint(200, 255), random.randint(200, 255), random.randint(200, 255)))
-    draw = ImageDraw.Draw(img)
-    
-    # 添加随机噪点
-    for _ in range(width * height // 10):
-        x = random.randint(0, width - 1)
-        y = random.randint(0, height - 1)
-        color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-        draw.point((x, y), fill=color)
-    
-    # 添加模拟缺陷点（1-5个）
-    for _ in range(random.randint(1, 5)):
-        x = random.randint(50, width - 50)
-        y = random.randint(50, height - 50)
-        size = random.randint(5, 20)
-        color = (random.randint(0, 100), random.randint(0, 100), random.randint(0, 100))
-        draw.ellipse((x - size, y - size, x + size, y + size), fill=color)
-    
-    return img
+    return Image.fromarray(stamp_defects(make_base(width, height)), 'RGB')
+
+# 保存图像缓冲区。PNG先在内存中完成编码，再一次性写入磁盘
+# （PIL直接写文件会产生大量小write调用）；PPM则跳过压缩，
+# 直接写P6头+原始字节，供只在内部回读的场景使用
+def save_image(arr, path, image_format='png'):
+    if image_format == 'ppm':
+        height, width = arr.shape[:2]
+        with open(path.with_suffix('.ppm'), 'wb') as f:
+            f.write(f"P6\n{width} {height}\n255\n".encode())
+            f.write(arr.tobytes())
+    else:
+        buf = io.BytesIO()
+        Image.fromarray(arr, 'RGB').save(buf, 'PNG', compress_level=1)
+        path.write_bytes(buf.getbuffer())
+
+# 生成单个晶圆的数据（顶层函数，便于multiprocessing序列化）
+def generate_one_wafer(task):
+    global _rng
+    base_path, wafer_type, i, xs, ys, types, seed, image_format = task
+    # 每个任务使用SeedSequence派生的独立随机流
+    _rng = np.random.default_rng(seed)
+
+    wafer_name = f"{wafer_type}-{i:02d}"
+    wafer_dir = Path(base_path) / wafer_name
+
+    # 创建晶圆文件夹（目录路径只构造一次，文件路径用/运算符拼接）
+    wafer_dir.mkdir(parents=True, exist_ok=True)
+
+    # 原生扩展可用时整个晶圆交给Rust侧生成（图像+raw_data.txt）
+    if dgen_wafer is not None:
+        dgen_wafer.generate_wafer(str(wafer_dir), wafer_name,
+                                  int(seed.generate_state(1)[0]))
+        return wafer_name
+
+    # 生成明场和暗场图像：共用一份背景+噪点，分别叠加不同缺陷
+    # （ndarray.copy只是一次memcpy，远比重新生成噪点便宜）
+    if _fill_image is not None:
+        # 融合内核：背景+噪点+缺陷一趟完成；两张图共用同一噪点seed
+        # （等价于共用同一份背景缓冲区），缺陷各自独立采样
+        bg_color = _rng.integers(200, 256, 3).astype(np.uint8)
+        noise_seed = int(_rng.integers(1, 1 << 62))
+        bright_field = np.empty((400, 600, 3), np.uint8)
+        _fill_image(bright_field, bg_color, _sample_defects(), noise_seed)
+        dark_field = np.empty((400, 600, 3), np.uint8)
+        _fill_image(dark_field, bg_color, _sample_defects(), noise_seed)
+    else:
+        base = make_base()
+        bright_field = stamp_defects(base.copy())
+        dark_field = stamp_defects(base)
+    saves = [_io_pool.submit(save_image, bright_field, wafer_dir / 'bright_field.png', image_format),
+             _io_pool.submit(save_image, dark_field, wafer_dir / 'dark_field.png', image_format)]
+
+    # 生成raw_data.txt文件（缺陷数据已在父进程批量采样）
+    # 一次tolist()把所有numpy标量转成Python int，再做行格式化
+    data = np.stack([xs, ys, types], axis=1).tolist()
+    rows = [f"DEF_{wafer_type}{i:02d}_{j:03d},{x},{y},{t}"
+            for j, (x, y, t) in enumerate(data, 1)]
+    with open(wafer_dir / 'raw_data.txt', 'w') as f:
+        f.write("defect_id,center_x,center_y,ai_adc_type\n" + "\n".join(rows) + "\n")
+
+    # 等待两张图像编码写盘完成
+    for s in saves:
+        s.result()
+
+    return wafer_name
 
 # 生成晶圆数据
-def generate_wafer_data(base_path, wafer_prefix, count, create_nested=False):
-    # 使用传入的前缀作为晶圆类型，而不是硬编码列表
-    wafer_types = [wafer_prefix]
-    
-    for wafer_type in wafer_types:
-        for i in range(1, count + 1):
-            wafer_name = f"{wafer_type}-{i:02d}"
-            wafer_dir = os.path.join(base_path, wafer_name)
-            
-            # 创建晶圆文件夹
-            os.makedirs(wafer_dir, exist_ok=True)
-            
-            # 生成明场和暗场图像
-            bright_field_img = generate_random_image()
-            bright_field_img.save(os.path.join(wafer_dir, 'bright_field.png'))
-            
-            dark_field_img = generate_random_image()
-            dark_field_img.save(os.path.join(wafer_dir, 'dark_field.png'))
-            
-            # 生成raw_data.txt文件
-            defect_count = random.randint(10, 20)
-            with open(os.path.join(wafer_dir, 'raw_data.txt'), 'w') as f:
-                f.write("defect_id,center_x,center_y,ai_adc_type\n")
-                for j in range(1, defect_count + 1):
-                    defect_id = f"DEF_{wafer_type}{i:02d}_{j:03d}"
-                    center_x = random.randint(100, 500)
-                    center_y = random.randint(100, 300)
-                    ai_adc_type = random.randint(1, 5)  # 1-5的缺陷类型
-                    f.write(f"{defect_id},{center_x},{center_y},{ai_adc_type}\n")
-            
-            print(f"已生成晶圆数据: {wafer_name}")
+def generate_wafer_data(base_path, wafer_prefix, count, seed=None, image_format='png'):
+    # 用SeedSequence.spawn为每个晶圆派生统计独立的子种子，
+    # 传入seed时整个生成过程可复现
+    children = np.random.SeedSequence(seed).spawn(count + 1)
+
+    # 所有晶圆的缺陷数据一次性批量采样，再按晶圆切片分发
+    rng = np.random.default_rng(children[-1])
+    counts = rng.integers(10, 21, count)
+    offsets = np.concatenate(([0], counts.cumsum()))
+    total = int(offsets[-1])
+    all_x = rng.integers(100, 501, total)
+    all_y = rng.integers(100, 301, total)
+    all_t = rng.integers(1, 6, total)  # 1-5的缺陷类型
+
+    # 各晶圆相互独立，用进程池并行生成
+    tasks = [(base_path, wafer_prefix, i,
+              all_x[offsets[i - 1]:offsets[i]],
+              all_y[offsets[i - 1]:offsets[i]],
+              all_t[offsets[i - 1]:offsets[i]],
+              children[i - 1], image_format)
+             for i in range(1, count + 1)]
+    if not tasks:
+        return  # count为0时无事可做，Pool不接受0个进程
+    with multiprocessing.Pool(min(os.cpu_count(), len(tasks))) as pool:
+        done = list(pool.imap_unordered(generate_one_wafer, tasks))
+
+    # 进度信息攒成一次stdout写出，避免热循环里逐条flush
+    sys.stdout.write("".join(f"已生成晶圆数据: {name}\n" for name in done))
 
 if __name__ == "__main__":
     # 当前目录作为基础路径
@@ -1,26 +1,199 @@
 import os
+import csv
+import queue
 import sqlite3
 import json
 import hashlib
 import shutil
 import tempfile
+import threading
+import time
+import itertools
+import functools
+import concurrent.futures
+import contextlib
+import logging
+import logging.handlers
+from collections import OrderedDict
 from datetime import datetime
+from urllib.parse import parse_qsl
+
+# NumPy可用时raw_data.txt走loadtxt快速解析路径，缺失时退回csv.reader
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# orjson（C/Rust实现的JSON编解码器）可用时用于API请求和响应的
+# 序列化，dumps直接产出bytes；缺失时退回标准库json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 # 全局索引库路径
 GLOBAL_INDEX_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wafer_global_index.db')
 
+log = logging.getLogger(__name__)
+
+# 日志经QueueHandler入队，由后台线程的QueueListener统一写出，
+# 请求线程只付一次入队的开销，不会阻塞在终端写入上
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.setLevel(logging.INFO)
+log.propagate = False
+
+class LRUBytesCache:
+    """按总字节数限容的LRU字节缓存。
+
+    用于缓存反复请求的图片内容，避免每次滚动都重新读盘。
+    条目记录文件mtime，文件被重新生成后旧缓存自动失效。
+    """
+
+    def __init__(self, max_bytes=128 << 20):
+        self._max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (mtime, bytes)
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, mtime):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] != mtime:
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, mtime, data):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._total -= len(old[1])
+            self._data[key] = (mtime, data)
+            self._total += len(data)
+            # 超出容量时从最久未用端逐出
+            while self._total > self._max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._total -= len(evicted)
+
+# 图片字节缓存（进程级）
+_image_cache = LRUBytesCache()
+
+# 每个线程持有一条到全局索引库的连接，线程内的多次查询免去重复
+# 建连，WAL允许各线程的读与写并发进行。注意ThreadingHTTPServer
+# 为每个请求新开线程，这些连接随请求线程结束由GC回收
+_TLS = threading.local()
+
+def _thread_conn():
+    conn = getattr(_TLS, 'conn', None)
+    if conn is None:
+        conn = _TLS.conn = _open_db(GLOBAL_INDEX_DB_PATH)
+    return conn
+
+# wafer_id到folder_path的映射在一次会话内基本不变，lru_cache
+# 省掉每次标注保存/图片请求的一次索引查询；文件夹重新加载或
+# 晶圆状态重置时调用cache_clear使其失效
+@functools.lru_cache(maxsize=1024)
+def _folder_path_for(wafer_id):
+    row = _thread_conn().execute(
+        "SELECT folder_path FROM wafer_metadata WHERE wafer_id = ?",
+        (wafer_id,)).fetchone()
+    return row[0] if row else None
+
+# 缺陷类型与数字编码的映射（正反两个方向），标注保存和数据
+# 返回的热路径上直接引用，不再每次调用重建字典
+_ADC_TYPE_MAP = {'Particle': 1, 'Scratch': 2, 'Stain': 3, 'Pinhole': 4, 'Other': 5}
+_ADC_TYPE_NAMES = {v: k for k, v in _ADC_TYPE_MAP.items()}
+
+# 已完成标注字段迁移的内层库路径。迁移后schema稳定，同一个库
+# 只探测/补列一次；库被删除重建时从集合中移除
+_migrated_dbs = set()
+
+# 标注相关的扩展字段（基础schema只有缺陷几何和类型信息）
+_LABEL_COLUMNS = (
+    ('severity', 'TEXT'),
+    ('comment', 'TEXT'),
+    ('label_time', 'INTEGER'),  # Unix秒，8字节，免去字符串格式化
+    ('label_count', 'INTEGER DEFAULT 0'),
+    ('label', 'TEXT'),
+    ('is_labeled', 'INTEGER DEFAULT 0'),
+)
+
+def _ensure_schema(inner_db_path):
+    """一次性补齐内层库的标注字段。
+
+    所有缺失列的ALTER放进同一个事务一次提交，保存热路径
+    不再做逐次的PRAGMA探测和迁移。
+    """
+    if inner_db_path in _migrated_dbs or not os.path.exists(inner_db_path):
+        return
+    conn = _open_db(inner_db_path)
+    try:
+        with conn:
+            cursor = conn.execute("PRAGMA table_info(defect_info)")
+            columns = {row[1] for row in cursor.fetchall()}
+            for name, decl in _LABEL_COLUMNS:
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE defect_info ADD COLUMN {name} {decl}")
+        _migrated_dbs.add(inner_db_path)
+    except Exception as e:
+        log.error("补齐标注字段失败: %s: %s", inner_db_path, e)
+    finally:
+        conn.close()
+
+# 高频SQL提升为模块常量：同一字符串对象配合连接的语句缓存，
+# 让prepared statement在多处调用间稳定复用
+_SQL_MARK_FAILED = '''
+UPDATE wafer_metadata 
+SET parsed_status = 2, parse_error = ?, last_operated = ? 
+WHERE wafer_id = ?
+'''
+
+def _open_db(db_path, check_same_thread=True):
+    """打开SQLite连接并应用统一的性能PRAGMA。
+
+    WAL模式允许读写并发且减少fsync次数（journal_mode会持久化
+    到库文件，其余PRAGMA为每连接设置）。语句缓存放大到256条，
+    配合长连接（管理器/线程本地/ATTACH），热路径SQL编译一次
+    后一直复用。
+    """
+    conn = sqlite3.connect(db_path, cached_statements=256,
+                           check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
 class OuterLayerManager:
     def __init__(self):
+        # 全局索引库复用一条长连接（页缓存、mmap视图跨调用保留）。
+        # ThreadingHTTPServer的工作线程也会经由管理器用到这条连接，
+        # 以check_same_thread=False打开，跨线程访问由可重入锁串行化
+        self._lock = threading.RLock()
+        self._conn = _open_db(GLOBAL_INDEX_DB_PATH, check_same_thread=False)
         # 初始化全局索引库
         self._init_global_index_db()
-    
+
     def _init_global_index_db(self):
         """初始化全局索引库，创建晶圆元数据表"""
-        conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-        cursor = conn.cursor()
-        
-        # 创建晶圆元数据表
-        cursor.execute('''
+        # 建表和建索引的DDL合成一个脚本，一次executescript调用
+        # 完成（executescript自带隐式事务提交）
+        self._conn.executescript('''
         CREATE TABLE IF NOT EXISTS wafer_metadata (
             wafer_id TEXT PRIMARY KEY,
             wafer_name TEXT NOT NULL,
@@ -33,19 +206,25 @@ class OuterLayerManager:
             parse_error TEXT,
             last_operated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        );
+        CREATE INDEX IF NOT EXISTS idx_folder_path ON wafer_metadata(folder_path);
+        CREATE INDEX IF NOT EXISTS idx_wafer_name ON wafer_metadata(wafer_name);
+        DROP INDEX IF EXISTS idx_label_status;
+        CREATE INDEX IF NOT EXISTS idx_label_status_name ON wafer_metadata(label_status, wafer_name);
         ''')
-        
-        # 创建索引
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_folder_path ON wafer_metadata(folder_path)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_label_status ON wafer_metadata(label_status)')
-        
-        conn.commit()
-        conn.close()
     
-    def _calculate_wafer_id(self, folder_path):
-        """计算晶圆ID：使用文件夹路径的SHA256作为唯一标识"""
-        return hashlib.sha256(folder_path.encode()).hexdigest()
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _calculate_wafer_id(folder_path):
+        """计算晶圆ID：使用文件夹路径的BLAKE2b-128作为唯一标识
+
+        BLAKE2b比SHA256快且128位对路径去重已绰绰有余，ID从64字符
+        缩短到32字符，全局索引的主键和索引也随之变小。
+        同一路径在加载、同步、进入内层等路径上会反复取ID，
+        用lru_cache把重复计算压成一次字典查找（staticmethod
+        避免缓存持有实例引用）。
+        """
+        return hashlib.blake2b(folder_path.encode(), digest_size=16).hexdigest()
     
     def _parse_wafer_folder(self, folder_path):
         """解析晶圆文件夹（模拟内层解析函数）"""
@@ -59,47 +238,43 @@ class OuterLayerManager:
            not os.path.exists(os.path.join(folder_path, 'dark_field.png')):
             raise Exception("明场/暗场图像文件缺失")
         
-        # 统计缺陷数量
-        with open(raw_data_path, 'r') as f:
-            lines = f.readlines()
-            # 减去表头行
-            defect_count = len(lines) - 1
-        
-        # 模拟创建内层数据库
-        self._create_inner_database(folder_path, raw_data_path, defect_count)
-        
-        return defect_count
+        # 创建内层数据库，缺陷数量以实际导入行数为准，
+        # 不再为了计数把整个raw_data.txt读进内存
+        return self._create_inner_database(folder_path, raw_data_path)
     
-    def _create_inner_database(self, folder_path, raw_data_path, defect_count):
-        """创建模拟的内层数据库"""
+    def _create_inner_database(self, folder_path, raw_data_path):
+        """创建模拟的内层数据库，返回实际导入的缺陷数量"""
         inner_db_path = os.path.join(folder_path, 'database.db')
-        print(f"开始创建内层数据库: {inner_db_path}")
+        log.info("开始创建内层数据库: %s", inner_db_path)
+        # 库要重建，标注字段的迁移标记随之失效
+        _migrated_dbs.discard(inner_db_path)
         
         # 确保文件夹存在
         if not os.path.exists(folder_path):
             try:
                 os.makedirs(folder_path)
-                print(f"已创建晶圆文件夹: {folder_path}")
+                log.info("已创建晶圆文件夹: %s", folder_path)
             except Exception as e:
-                print(f"创建文件夹失败: {e}")
-                return
+                log.error("创建文件夹失败: %s", e)
+                return 0
         
         # 先删除可能存在的旧数据库
         if os.path.exists(inner_db_path):
             try:
                 os.remove(inner_db_path)
-                print(f"已删除旧数据库文件")
+                log.debug("已删除旧数据库文件")
             except Exception as e:
-                print(f"删除旧数据库文件失败: {e}")
+                log.error("删除旧数据库文件失败: %s", e)
         
         conn = None
+        actual_count = 0
         try:
             # 创建新的数据库连接
-            conn = sqlite3.connect(inner_db_path)
+            conn = _open_db(inner_db_path)
             cursor = conn.cursor()
             
             # 创建缺陷信息表（使用标准SQLite语法）
-            print("创建defect_info表结构")
+            log.debug("创建defect_info表结构")
             create_table_sql = '''
             CREATE TABLE IF NOT EXISTS defect_info (
                 defect_id TEXT PRIMARY KEY,
@@ -111,79 +286,103 @@ class OuterLayerManager:
             '''
             cursor.execute(create_table_sql)
             
-            # 创建索引以提高查询性能
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_defect_id ON defect_info(defect_id)")
-            
+            # defect_id是主键，SQLite自带索引，无需再建一份
             # 导入原始数据
-            print(f"开始导入原始数据，raw_data_path={raw_data_path}")
-            
-            # 使用事务批量插入以提高性能
-            conn.execute("BEGIN TRANSACTION")
-            
-            with open(raw_data_path, 'r') as f:
-                # 读取所有行并过滤
-                lines = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
-                if not lines:
-                    print("警告：raw_data.txt文件为空或只包含注释行")
-                    conn.rollback()
-                    return
-                
-                # 跳过表头（第一行）
-                data_lines = lines[1:]
-                print(f"跳过表头，实际数据行数: {len(data_lines)}")
-                
-                inserted_count = 0
-                skipped_count = 0
-                
-                # 准备批量插入的数据
-                insert_data = []
-                for line_num, line in enumerate(data_lines, start=2):  # 从第2行开始计数
+            log.info("开始导入原始数据，raw_data_path=%s", raw_data_path)
+
+            stats = {'inserted': 0, 'skipped': 0}
+
+            # 解析生成器：逐行产出参数元组，直接喂给executemany，
+            # 行数据从文件流式进入SQLite，不再整表攒在内存里。
+            # 字段切分交给C实现的csv.reader完成
+            def _iter_rows(reader):
+                for line_num, row in enumerate(reader, start=2):  # 从第2行开始计数
+                    if not row or row[0].startswith('#'):
+                        continue
+                    # 严格检查字段数量和格式
+                    if len(row) < 4:
+                        log.debug("跳过第%d行：字段数量不足: %s", line_num, row)
+                        stats['skipped'] += 1
+                        continue
+                    defect_id = row[0].strip()
+                    if not defect_id:
+                        log.debug("跳过第%d行：缺陷ID为空", line_num)
+                        stats['skipped'] += 1
+                        continue
+
+                    # 转换数值字段
                     try:
-                        parts = line.split(',')
-                        # 严格检查字段数量和格式
-                        if len(parts) >= 4:
-                            defect_id = parts[0].strip()
-                            if not defect_id:
-                                print(f"跳过第{line_num}行：缺陷ID为空")
-                                skipped_count += 1
-                                continue
-                            
-                            # 转换数值字段
-                            try:
-                                center_x = int(parts[1].strip())
-                                center_y = int(parts[2].strip())
-                                ai_adc_type = int(parts[3].strip())
-                            except ValueError as ve:
-                                print(f"跳过第{line_num}行：数值转换失败: {ve}, 行内容: {line}")
-                                skipped_count += 1
-                                continue
-                            
-                            # 添加到批量数据中，初始时adc_type设为None表示未标注状态
-                            insert_data.append((defect_id, center_x, center_y, ai_adc_type, None))
-                            inserted_count += 1
-                        else:
-                            print(f"跳过第{line_num}行：字段数量不足: {line}")
-                            skipped_count += 1
-                    except Exception as e:
-                        print(f"处理第{line_num}行失败: {e}, 行内容: {line}")
-                        skipped_count += 1
+                        center_x = int(row[1])
+                        center_y = int(row[2])
+                        ai_adc_type = int(row[3])
+                    except ValueError as ve:
+                        log.debug("跳过第%d行：数值转换失败: %s, 行内容: %s", line_num, ve, row)
+                        stats['skipped'] += 1
                         continue
-                
-                # 执行批量插入
-                if insert_data:
-                    print(f"准备插入{len(insert_data)}条记录")
-                    cursor.executemany(
-                        "INSERT OR REPLACE INTO defect_info (defect_id, center_x, center_y, ai_adc_type, adc_type) VALUES (?, ?, ?, ?, ?)",
-                        insert_data
-                    )
-                
-                # 提交事务
-                conn.commit()
+
+                    # 初始时adc_type设为None表示未标注状态
+                    stats['inserted'] += 1
+                    yield (defect_id, center_x, center_y, ai_adc_type, None)
+
+            # 使用事务批量插入以提高性能。每500行拼成一条多行
+            # VALUES语句（5列×500=2500个参数，远低于SQLite的
+            # 32766上限），减少逐行的VDBE调度开销
+            chunk_size = 500
+            insert_sql = ("INSERT OR REPLACE INTO defect_info "
+                          "(defect_id, center_x, center_y, ai_adc_type, adc_type) VALUES ")
+            full_chunk_sql = insert_sql + ",".join(["(?, ?, ?, ?, ?)"] * chunk_size)
+
+            def _insert_chunks(rows):
+                while True:
+                    chunk = list(itertools.islice(rows, chunk_size))
+                    if not chunk:
+                        break
+                    flat_params = list(itertools.chain.from_iterable(chunk))
+                    if len(chunk) == chunk_size:
+                        cursor.execute(full_chunk_sql, flat_params)
+                    else:
+                        cursor.execute(insert_sql + ",".join(["(?, ?, ?, ?, ?)"] * len(chunk)),
+                                       flat_params)
+
+            # NumPy可用时先尝试loadtxt快速路径：切分和数值转换一趟
+            # 在C层完成，对格式规整的文件比逐行csv解析快得多；
+            # 任何异常（字段缺失、数值非法等）都退回下面的宽容路径
+            fast_rows = None
+            if np is not None:
+                try:
+                    arr = np.loadtxt(raw_data_path, delimiter=',', skiprows=1,
+                                     usecols=(0, 1, 2, 3), ndmin=1,
+                                     dtype=[('id', 'U64'), ('x', 'i8'),
+                                            ('y', 'i8'), ('t', 'i8')])
+                    fast_rows = [(d, x, y, t, None) for d, x, y, t in arr.tolist()]
+                    stats['inserted'] = len(fast_rows)
+                except Exception as e:
+                    log.debug("NumPy快速解析失败，退回csv解析: %s", e)
+
+            conn.execute("BEGIN IMMEDIATE")
+            if fast_rows is not None:
+                _insert_chunks(iter(fast_rows))
+            else:
+                with open(raw_data_path, 'r', newline='', buffering=1 << 20) as f:
+                    reader = csv.reader(f, skipinitialspace=True)
+                    # 跳过表头（第一行）
+                    if next(reader, None) is None:
+                        log.warning("raw_data.txt文件为空")
+                        conn.rollback()
+                        return 0
+                    _insert_chunks(_iter_rows(reader))
+
+            # 提交事务
+            conn.commit()
+
+            inserted_count = stats['inserted']
+            skipped_count = stats['skipped']
             
             # 验证数据插入是否成功
             cursor.execute("SELECT COUNT(*) FROM defect_info")
             actual_count = cursor.fetchone()[0]
-            print(f"内层数据库创建完成，计划插入{inserted_count}条，实际插入{actual_count}条，跳过{skipped_count}条")
+            log.info("内层数据库创建完成，计划插入%d条，实际插入%d条，跳过%d条",
+                     inserted_count, actual_count, skipped_count)
             
             # 验证表结构是否正确
             cursor.execute("PRAGMA table_info(defect_info)")
@@ -191,12 +390,10 @@ class OuterLayerManager:
             required_columns = ['defect_id', 'center_x', 'center_y', 'ai_adc_type', 'adc_type']
             missing_columns = [col for col in required_columns if col not in columns]
             if missing_columns:
-                print(f"警告：表结构不完整，缺少列: {missing_columns}")
+                log.warning("表结构不完整，缺少列: %s", missing_columns)
             
         except sqlite3.Error as e:
-            print(f"SQLite错误: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("SQLite错误: %s", e)
             # 回滚事务
             if conn:
                 try:
@@ -204,9 +401,7 @@ class OuterLayerManager:
                 except:
                     pass
         except Exception as e:
-            print(f"创建内层数据库失败: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("创建内层数据库失败: %s", e)
             # 回滚事务
             if conn:
                 try:
@@ -222,13 +417,19 @@ class OuterLayerManager:
                     pass
             
             # 如果创建失败，删除数据库文件
-            if 'actual_count' not in locals() or actual_count == 0:
+            if actual_count == 0:
                 if os.path.exists(inner_db_path):
                     try:
                         os.remove(inner_db_path)
-                        print(f"因创建失败，已删除空数据库文件")
+                        log.info("因创建失败，已删除空数据库文件")
                     except Exception as e:
-                        print(f"删除失败数据库文件时出错: {e}")
+                        log.error("删除失败数据库文件时出错: %s", e)
+
+        # 新建的库立即补齐标注字段，保存路径无需再做迁移
+        if actual_count:
+            _ensure_schema(inner_db_path)
+
+        return actual_count
     
     def load_wafer_folders(self, root_dir, recursive=True):
         """加载晶圆文件夹并更新全局索引库"""
@@ -236,92 +437,125 @@ class OuterLayerManager:
         success_count = 0
         fail_count = 0
         
-        # 获取所有晶圆文件夹
+        # 获取所有晶圆文件夹。用os.scandir遍历：DirEntry的类型
+        # 信息来自目录项缓存，不像os.walk+exists那样逐项补stat
         wafer_folders = []
         if recursive:
-            for root, dirs, files in os.walk(root_dir):
-                if 'raw_data.txt' in files:
-                    wafer_folders.append(root)
+            stack = [root_dir]
+            while stack:
+                current = stack.pop()
+                try:
+                    with os.scandir(current) as entries:
+                        found = False
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif entry.name == 'raw_data.txt' and entry.is_file(follow_symlinks=False):
+                                found = True
+                    if found:
+                        wafer_folders.append(current)
+                except OSError as e:
+                    print(f"扫描目录失败: {current}, 错误: {e}")
         else:
-            # 仅搜索一级目录
-            for item in os.listdir(root_dir):
-                item_path = os.path.join(root_dir, item)
-                if os.path.isdir(item_path) and os.path.exists(os.path.join(item_path, 'raw_data.txt')):
-                    wafer_folders.append(item_path)
-        
-        conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-        cursor = conn.cursor()
-        
+            # 仅搜索一级目录。raw_data.txt的存在性检查在NAS等高延迟
+            # 存储上以stat往返为主，用线程池并发发起以重叠等待
+            with os.scandir(root_dir) as entries:
+                candidates = [entry.path for entry in entries
+                              if entry.is_dir(follow_symlinks=False)]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+                checks = pool.map(
+                    lambda p: os.path.exists(os.path.join(p, 'raw_data.txt')), candidates)
+            wafer_folders = [p for p, ok in zip(candidates, checks) if ok]
+        
+        # 先在锁内一次查出已注册的晶圆，区分新增和已存在两类
+        with self._lock:
+            cursor = self._conn.execute("SELECT wafer_id FROM wafer_metadata")
+            known_ids = {row[0] for row in cursor.fetchall()}
+
+        new_folders = []
+        existing_folders = []
         for folder_path in wafer_folders:
             wafer_id = self._calculate_wafer_id(folder_path)
-            wafer_name = os.path.basename(folder_path)
-            inner_db_path = os.path.join(folder_path, 'database.db')
-            
-            try:
-                # 检查全局索引库是否已有记录
-                cursor.execute("SELECT * FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
-                existing_record = cursor.fetchone()
-                
-                # 检查是否存在内层数据库
-                has_inner_db = os.path.exists(inner_db_path)
-                
-                if not existing_record and not has_inner_db:
-                    # 首次加载，需要解析
-                    total_defects = self._parse_wafer_folder(folder_path)
-                    
-                    # 插入到全局索引库
-                    cursor.execute('''
-                    INSERT INTO wafer_metadata 
-                    (wafer_id, wafer_name, folder_path, total_defects, 
-                     progress, label_status, parsed_status, last_operated)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (wafer_id, wafer_name, folder_path, total_defects, 0, 0.0, 0, 1, datetime.now()))
-                    
-                    success_count += 1
-                    
-                elif existing_record or has_inner_db:
-                    # 已存在记录或内层数据库，需要刷新数据
-                    if not existing_record:
-                        # 有内层数据库但无索引记录，需要解析
-                        total_defects = self._parse_wafer_folder(folder_path)
-                        cursor.execute('''
-                        INSERT INTO wafer_metadata 
-                        (wafer_id, wafer_name, folder_path, total_defects, 
-                         progress, label_status, parsed_status, last_operated)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (wafer_id, wafer_name, folder_path, total_defects, 0, 0.0, 0, 1, datetime.now()))
-                    else:
-                        # 刷新进度和状态 - 强制重新创建内层数据库确保数据一致性
-                        print(f"对已存在晶圆强制重新同步进度: {wafer_name}")
-                        self._sync_progress(conn, wafer_id, folder_path)
-                    
+            if wafer_id in known_ids:
+                existing_folders.append((wafer_id, folder_path))
+            else:
+                new_folders.append((wafer_id, folder_path))
+
+        # 新晶圆的解析互不相关（各写各的内层数据库，不碰全局索引），
+        # 用线程池并行执行，读文件和SQLite导入的等待相互重叠
+        parse_results = []
+        if new_folders:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+                futures = [(wafer_id, folder_path,
+                            pool.submit(self._parse_wafer_folder, folder_path))
+                           for wafer_id, folder_path in new_folders]
+                for wafer_id, folder_path, future in futures:
+                    try:
+                        parse_results.append((wafer_id, folder_path, future.result(), None))
+                    except Exception as e:
+                        parse_results.append((wafer_id, folder_path, None, str(e)))
+
+        with self._lock:
+            conn = self._conn
+            cursor = conn.cursor()
+            new_rows = []
+            failed_updates = []
+            failed_inserts = []
+
+            # 已存在的晶圆先逐个同步。_sync_progress内部会ATTACH内层库，
+            # 不能在显式事务中进行，所以放在批量事务之前
+            for wafer_id, folder_path in existing_folders:
+                wafer_name = os.path.basename(folder_path)
+                try:
+                    # 刷新进度和状态 - 强制重新创建内层数据库确保数据一致性
+                    print(f"对已存在晶圆强制重新同步进度: {wafer_name}")
+                    self._sync_progress(conn, wafer_id, folder_path)
                     success_count += 1
-                    
+                except Exception as e:
+                    error_msg = str(e)
+                    print(f"处理晶圆失败: {wafer_name}, 错误: {error_msg}")
+                    failed_updates.append((error_msg, datetime.now(), wafer_id))
+                    fail_count += 1
                 processed_count += 1
-                
-            except Exception as e:
-                # 解析失败，更新状态
-                error_msg = str(e)
-                print(f"处理晶圆失败: {wafer_name}, 错误: {error_msg}")
-                
-                if existing_record:
-                    cursor.execute('''
-                    UPDATE wafer_metadata 
-                    SET parsed_status = 2, parse_error = ?, last_operated = ? 
-                    WHERE wafer_id = ?
-                    ''', (error_msg, datetime.now(), wafer_id))
+            conn.commit()
+
+            # 新晶圆的全局索引写入攒成批量，在一个显式事务中一次提交，
+            # 避免每个文件夹一次fsync
+            conn.execute("BEGIN IMMEDIATE")
+
+            for wafer_id, folder_path, total_defects, error_msg in parse_results:
+                wafer_name = os.path.basename(folder_path)
+                if error_msg is None:
+                    new_rows.append((wafer_id, wafer_name, folder_path, total_defects,
+                                     0.0, 0, 1, datetime.now()))
+                    success_count += 1
                 else:
-                    cursor.execute('''
-                    INSERT INTO wafer_metadata 
-                    (wafer_id, wafer_name, folder_path, parsed_status, parse_error, last_operated)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (wafer_id, wafer_name, folder_path, 2, error_msg, datetime.now()))
-                
-                fail_count += 1
+                    print(f"处理晶圆失败: {wafer_name}, 错误: {error_msg}")
+                    failed_inserts.append((wafer_id, wafer_name, folder_path, 2,
+                                           error_msg, datetime.now()))
+                    fail_count += 1
                 processed_count += 1
+
+            if new_rows:
+                cursor.executemany('''
+                INSERT INTO wafer_metadata
+                (wafer_id, wafer_name, folder_path, total_defects,
+                 progress, label_status, parsed_status, last_operated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', new_rows)
+            if failed_updates:
+                cursor.executemany(_SQL_MARK_FAILED, failed_updates)
+            if failed_inserts:
+                cursor.executemany('''
+                INSERT INTO wafer_metadata
+                (wafer_id, wafer_name, folder_path, parsed_status, parse_error, last_operated)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ''', failed_inserts)
+
+            conn.commit()
         
-        conn.commit()
-        conn.close()
+        # 晶圆集合可能已变化，清掉路径映射缓存
+        _folder_path_for.cache_clear()
         
         return {
             'total_processed': processed_count,
@@ -332,16 +566,15 @@ class OuterLayerManager:
     def enter_inner_layer(self, wafer_id):
         """进入内层标注功能，准备内层数据库"""
         print(f"尝试进入内层标注: wafer_id={wafer_id}")
-        
-        conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-        cursor = conn.cursor()
-        
-        # 获取晶圆信息
-        cursor.execute("SELECT wafer_name, folder_path FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
-        result = cursor.fetchone()
-        
+
+        with self._lock:
+            cursor = self._conn.cursor()
+
+            # 获取晶圆信息
+            cursor.execute("SELECT wafer_name, folder_path FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
+            result = cursor.fetchone()
+
         if not result:
-            conn.close()
             return False, "晶圆不存在"
         
         wafer_name, folder_path = result
@@ -351,41 +584,37 @@ class OuterLayerManager:
         try:
             # 确保原始数据文件存在
             if not os.path.exists(raw_data_path):
-                conn.close()
                 return False, "原始数据文件不存在"
             
-            # 确保内层数据库存在且有效
+            # 确保内层数据库存在且有效（重建与其他内层库操作互斥）
             if not os.path.exists(inner_db_path):
                 print(f"内层数据库不存在，尝试重建: {inner_db_path}")
                 # 重新创建内层数据库
-                with open(raw_data_path, 'r') as f:
-                    lines = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
-                    defect_count = len(lines) - 1 if len(lines) > 0 else 0
-                
-                self._create_inner_database(folder_path, raw_data_path, defect_count)
+                with self._lock:
+                    self._create_inner_database(folder_path, raw_data_path)
             
-            # 验证内层数据库完整性
-            inner_conn = sqlite3.connect(inner_db_path)
-            inner_cursor = inner_conn.cursor()
-            
-            # 检查必要的表是否存在
-            inner_cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='defect_info'")
-            if not inner_cursor.fetchone():
-                inner_conn.close()
-                conn.close()
-                return False, "内层数据库表结构不完整"
+            # 验证内层数据库完整性：内层库ATTACH到全局连接上查询，
+            # 免去为两条只读语句新开一个SQLite连接
+            with self._lock:
+                conn = self._conn
+                conn.commit()  # ATTACH不能在事务内执行
+                conn.execute("ATTACH DATABASE ? AS inner_db", (inner_db_path,))
+                try:
+                    # 检查必要的表是否存在
+                    cursor = conn.execute(
+                        "SELECT name FROM inner_db.sqlite_master WHERE type='table' AND name='defect_info'")
+                    if not cursor.fetchone():
+                        return False, "内层数据库表结构不完整"
+                    
+                    # 检查是否有数据
+                    cursor = conn.execute("SELECT COUNT(*) FROM inner_db.defect_info")
+                    count = cursor.fetchone()[0]
+                finally:
+                    conn.execute("DETACH DATABASE inner_db")
             
-            # 检查是否有数据
-            inner_cursor.execute("SELECT COUNT(*) FROM defect_info")
-            count = inner_cursor.fetchone()[0]
             if count == 0:
-                inner_conn.close()
-                conn.close()
                 return False, "内层数据库没有缺陷数据"
             
-            inner_conn.close()
-            conn.close()
-            
             print(f"成功进入内层标注: {wafer_name}")
             return True, "成功进入内层标注"
         
@@ -395,13 +624,9 @@ class OuterLayerManager:
             traceback.print_exc()
             
             # 更新解析状态为失败
-            cursor.execute('''
-            UPDATE wafer_metadata 
-            SET parsed_status = 2, parse_error = ?, last_operated = ? 
-            WHERE wafer_id = ?
-            ''', (f"进入内层失败: {str(e)}", datetime.now(), wafer_id))
-            conn.commit()
-            conn.close()
+            with self._lock:
+                self._conn.execute(_SQL_MARK_FAILED, (f"进入内层失败: {str(e)}", datetime.now(), wafer_id))
+                self._conn.commit()
             
             return False, str(e)
 
@@ -417,11 +642,7 @@ class OuterLayerManager:
         if not os.path.exists(raw_data_path):
             print(f"错误: raw_data.txt文件不存在: {raw_data_path}")
             # 更新状态为解析失败
-            cursor.execute('''
-            UPDATE wafer_metadata 
-            SET parsed_status = 2, parse_error = ?, last_operated = ? 
-            WHERE wafer_id = ?
-            ''', ("raw_data.txt文件不存在", datetime.now(), wafer_id))
+            cursor.execute(_SQL_MARK_FAILED, ("raw_data.txt文件不存在", datetime.now(), wafer_id))
             return
         
         # 强制删除并重新创建内层数据库，确保状态干净
@@ -434,32 +655,14 @@ class OuterLayerManager:
         
         # 重新创建内层数据库
         try:
-            # 计算缺陷数量并过滤可能的注释行
-            with open(raw_data_path, 'r') as f:
-                lines = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
-                if len(lines) < 1:
-                    print(f"错误: raw_data.txt文件为空或格式不正确")
-                    cursor.execute('''
-                    UPDATE wafer_metadata 
-                    SET parsed_status = 2, parse_error = ?, last_operated = ? 
-                    WHERE wafer_id = ?
-                    ''', ("raw_data.txt文件为空或格式不正确", datetime.now(), wafer_id))
-                    return
-                defect_count = len(lines) - 1  # 减去表头行
-                if defect_count < 0:
-                    defect_count = 0
-            
-            print(f"计算到缺陷数量: {defect_count}")
-            self._create_inner_database(folder_path, raw_data_path, defect_count)
+            # 缺陷数量以_create_inner_database实际导入的行数为准
+            defect_count = self._create_inner_database(folder_path, raw_data_path)
+            print(f"导入到缺陷数量: {defect_count}")
             
             # 验证数据库是否创建成功
             if not os.path.exists(inner_db_path):
                 print(f"错误: 内层数据库创建失败，文件不存在")
-                cursor.execute('''
-                UPDATE wafer_metadata 
-                SET parsed_status = 2, parse_error = ?, last_operated = ? 
-                WHERE wafer_id = ?
-                ''', ("内层数据库创建失败", datetime.now(), wafer_id))
+                cursor.execute(_SQL_MARK_FAILED, ("内层数据库创建失败", datetime.now(), wafer_id))
                 return
             
         except Exception as e:
@@ -467,71 +670,55 @@ class OuterLayerManager:
             import traceback
             traceback.print_exc()
             # 更新状态为解析失败
-            cursor.execute('''
-            UPDATE wafer_metadata 
-            SET parsed_status = 2, parse_error = ?, last_operated = ? 
-            WHERE wafer_id = ?
-            ''', (f"创建数据库失败: {str(e)}", datetime.now(), wafer_id))
+            cursor.execute(_SQL_MARK_FAILED, (f"创建数据库失败: {str(e)}", datetime.now(), wafer_id))
             return
         
         try:
-            # 连接内层数据库
-            inner_conn = sqlite3.connect(inner_db_path)
-            inner_cursor = inner_conn.cursor()
-            
-            # 检查defect_info表是否存在
-            print("检查defect_info表是否存在")
-            inner_cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='defect_info'")
-            if not inner_cursor.fetchone():
-                print("错误: defect_info表不存在，数据库创建不完整")
-                inner_conn.close()
-                cursor.execute('''
-                UPDATE wafer_metadata 
-                SET parsed_status = 2, parse_error = ?, last_operated = ? 
-                WHERE wafer_id = ?
-                ''', ("数据库表结构不完整", datetime.now(), wafer_id))
-                return
-            
-            # 统计总缺陷数
-            print("执行统计总缺陷数查询")
-            inner_cursor.execute("SELECT COUNT(*) FROM defect_info")
-            total_defects = inner_cursor.fetchone()[0]
-            print(f"总缺陷数: {total_defects}")
+            # 内层库ATTACH到全局连接上查询，免去每次同步新开一个
+            # SQLite连接；ATTACH不能在事务内执行，先提交挂起的写入
+            conn.commit()
+            conn.execute("ATTACH DATABASE ? AS inner_db", (inner_db_path,))
+            try:
+                # 检查defect_info表是否存在
+                print("检查defect_info表是否存在")
+                cursor.execute(
+                    "SELECT name FROM inner_db.sqlite_master WHERE type='table' AND name='defect_info'")
+                if not cursor.fetchone():
+                    print("错误: defect_info表不存在，数据库创建不完整")
+                    cursor.execute(_SQL_MARK_FAILED, ("数据库表结构不完整", datetime.now(), wafer_id))
+                    return
+                
+                # 列探测只做一次，确定"已标注"的判断表达式
+                # （使用label_count字段时，只要标注次数>=1就视为已标注）
+                cursor.execute("PRAGMA inner_db.table_info(defect_info)")
+                columns = [col[1] for col in cursor.fetchall()]
+                
+                if 'label_count' in columns:
+                    labeled_expr = "label_count >= 1"
+                elif 'severity' in columns:
+                    # 兼容旧的判断方式
+                    labeled_expr = "ai_adc_type != adc_type OR (severity IS NOT NULL AND severity != '')"
+                else:
+                    # 回退到原来的判断方式
+                    labeled_expr = "ai_adc_type != adc_type"
+                
+                # 总数和已标注数在一次全表扫描里一并统计
+                count_sql = ("SELECT COUNT(*), COALESCE(SUM(CASE WHEN " + labeled_expr +
+                             " THEN 1 ELSE 0 END), 0) FROM inner_db.defect_info")
+                cursor.execute(count_sql)
+                total_defects, labeled_defects = cursor.fetchone()
+                print(f"总缺陷数: {total_defects}, 已标注数: {labeled_defects}")
+            finally:
+                conn.commit()  # DETACH同样要求没有挂起的事务
+                conn.execute("DETACH DATABASE inner_db")
             
-            # 如果没有数据，可能是导入失败
+            # 导入刚刚完成且计数已核对过，查询结果为0而预期大于0
+            # 说明导入确实失败了，直接标记失败，不再原地重试
             if total_defects == 0 and defect_count > 0:
-                print(f"警告: 缺陷数据导入失败，预期{defect_count}条，实际0条")
-                # 尝试重新导入一次
-                print("尝试重新导入缺陷数据...")
-                self._create_inner_database(folder_path, raw_data_path, defect_count)
-                # 重新查询
-                inner_cursor.execute("SELECT COUNT(*) FROM defect_info")
-                total_defects = inner_cursor.fetchone()[0]
-                print(f"重新导入后总缺陷数: {total_defects}")
-            
-            # 统计已标注数（使用label_count字段，只要标注次数>=1就视为已标注）
-            print("执行统计已标注数查询")
-            # 先检查表中是否有label_count字段
-            inner_cursor.execute("PRAGMA table_info(defect_info)")
-            columns = [col[1] for col in inner_cursor.fetchall()]
-            
-            if 'label_count' in columns:
-                # 使用label_count字段统计已标注的缺陷数量
-                inner_cursor.execute("SELECT COUNT(*) FROM defect_info WHERE label_count >= 1")
-                labeled_defects = inner_cursor.fetchone()[0]
-                print(f"已标注数(基于label_count): {labeled_defects}")
-            elif 'severity' in columns:
-                # 兼容旧的判断方式
-                inner_cursor.execute("SELECT COUNT(*) FROM defect_info WHERE ai_adc_type != adc_type OR (severity IS NOT NULL AND severity != '')")
-                labeled_defects = inner_cursor.fetchone()[0]
-                print(f"已标注数(基于类型差异或severity值): {labeled_defects}")
-            else:
-                # 回退到原来的判断方式
-                inner_cursor.execute("SELECT COUNT(*) FROM defect_info WHERE ai_adc_type != adc_type")
-                labeled_defects = inner_cursor.fetchone()[0]
-                print(f"已标注数(基于类型差异): {labeled_defects}")
-            
-            inner_conn.close()
+                print(f"错误: 缺陷数据导入失败，预期{defect_count}条，实际0条")
+                cursor.execute(_SQL_MARK_FAILED,
+                               (f"缺陷数据导入失败，预期{defect_count}条", datetime.now(), wafer_id))
+                return
             
             # 计算进度
             progress = (labeled_defects / total_defects * 100) if total_defects > 0 else 0
@@ -562,33 +749,35 @@ class OuterLayerManager:
             import traceback
             traceback.print_exc()
             # 更新状态为解析失败
-            cursor.execute('''
-            UPDATE wafer_metadata 
-            SET parsed_status = 2, parse_error = ?, last_operated = ? 
-            WHERE wafer_id = ?
-            ''', (f"同步失败: {str(e)}", datetime.now(), wafer_id))
+            cursor.execute(_SQL_MARK_FAILED, (f"同步失败: {str(e)}", datetime.now(), wafer_id))
 
     def sync_wafer_progress(self, wafer_id):
         """手动触发晶圆进度同步"""
-        conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-        cursor = conn.cursor()
-        
-        # 获取晶圆文件夹路径
-        cursor.execute("SELECT folder_path FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            folder_path = result[0]
-            self._sync_progress(conn, wafer_id, folder_path)
-            
-        conn.commit()
-        conn.close()
-        
+        with self._lock:
+            conn = self._conn
+            cursor = conn.cursor()
+
+            # 获取晶圆文件夹路径
+            cursor.execute("SELECT folder_path FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
+            result = cursor.fetchone()
+
+            if result:
+                folder_path = result[0]
+                self._sync_progress(conn, wafer_id, folder_path)
+
+            conn.commit()
+
         return result is not None
     
     def reset_wafer_status(self, wafer_id):
         """重置晶圆状态，删除内层数据库和相关缓存，允许重新加载晶圆"""
-        conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
+        with self._lock:
+            result = self._reset_wafer_status_locked(wafer_id)
+        _folder_path_for.cache_clear()
+        return result
+
+    def _reset_wafer_status_locked(self, wafer_id):
+        conn = self._conn
         cursor = conn.cursor()
         
         # 获取晶圆文件夹路径
@@ -621,120 +810,105 @@ class OuterLayerManager:
         else:
             success = False
         
-        conn.close()
         return success
     
     def get_wafer_list(self):
         """获取晶圆列表"""
-        conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-        conn.row_factory = sqlite3.Row  # 允许通过列名访问
-        cursor = conn.cursor()
-        
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.row_factory = sqlite3.Row  # 允许通过列名访问
+            return self._fetch_wafer_list(cursor)
+
+    def _fetch_wafer_list(self, cursor):
         try:
-            # 查询所有晶圆信息
-            cursor.execute("SELECT * FROM wafer_metadata")
-            wafers = []
-            
-            for row in cursor.fetchall():
-                wafer = dict(row)
-                # 确保每个晶圆都有完整的必要字段
-                wafer.setdefault('wafer_id', '')
-                wafer.setdefault('wafer_name', '')
-                wafer.setdefault('folder_path', '')
-                wafer.setdefault('parsed_status', 0)
-                wafer.setdefault('parse_error', '')
-                wafer.setdefault('label_status', 0)
-                wafer.setdefault('progress', 0.0)
-                wafer.setdefault('total_defects', 0)
-                wafer.setdefault('labeled_defects', 0)
-                wafer.setdefault('last_operated', '')
-                wafers.append(wafer)
-            
-            # 按晶圆名称排序
-            wafers.sort(key=lambda x: x['wafer_name'])
-            
-            return wafers
+            # 显式列出所需字段并用COALESCE补默认值，字段齐全性
+            # 由SQL保证，无需再对每个dict逐项setdefault；
+            # 排序交给idx_wafer_name索引完成
+            cursor.execute('''
+            SELECT wafer_id, wafer_name, folder_path,
+                   COALESCE(parsed_status, 0) AS parsed_status,
+                   COALESCE(parse_error, '') AS parse_error,
+                   COALESCE(label_status, 0) AS label_status,
+                   COALESCE(progress, 0.0) AS progress,
+                   COALESCE(total_defects, 0) AS total_defects,
+                   COALESCE(labeled_defects, 0) AS labeled_defects,
+                   COALESCE(last_operated, '') AS last_operated
+            FROM wafer_metadata ORDER BY wafer_name
+            ''')
+            return [dict(row) for row in cursor.fetchall()]
         except Exception as e:
             print(f"获取晶圆列表失败: {str(e)}")
             return []
-        finally:
-            conn.close()
     
     def export_wafer_kfl(self, wafer_id, export_all=False):
         """导出单个晶圆的KFL文件"""
-        conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-        cursor = conn.cursor()
-        
-        # 获取晶圆信息
-        cursor.execute("SELECT wafer_name, folder_path, label_status FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
-        result = cursor.fetchone()
+        with self._lock:
+            cursor = self._conn.cursor()
+            # 获取晶圆信息
+            cursor.execute("SELECT wafer_name, folder_path, label_status FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
+            result = cursor.fetchone()
         
         if not result:
-            conn.close()
             return None, "晶圆不存在"
         
         wafer_name, folder_path, label_status = result
         inner_db_path = os.path.join(folder_path, 'database.db')
         
         if not os.path.exists(inner_db_path):
-            conn.close()
             return None, "内层数据库不存在"
         
         # 连接内层数据库
-        inner_conn = sqlite3.connect(inner_db_path)
+        inner_conn = _open_db(inner_db_path)
         inner_cursor = inner_conn.cursor()
         
-        # 查询要导出的缺陷数据
+        # 查询要导出的缺陷数据。列显式列出，保证流式写出的行
+        # 与KFL表头一致（表里还有标注用的扩展字段，不导出）
+        export_cols = "defect_id, center_x, center_y, ai_adc_type, adc_type"
         if export_all or label_status == 2:
             # 导出所有缺陷
-            inner_cursor.execute("SELECT * FROM defect_info")
+            inner_cursor.execute(f"SELECT {export_cols} FROM defect_info")
         else:
             # 仅导出已标注的缺陷
-            inner_cursor.execute("SELECT * FROM defect_info WHERE ai_adc_type != adc_type")
-        
-        defects = inner_cursor.fetchall()
-        inner_conn.close()
-        conn.close()
+            inner_cursor.execute(f"SELECT {export_cols} FROM defect_info WHERE ai_adc_type != adc_type")
         
         # 创建临时目录保存导出文件
         temp_dir = tempfile.mkdtemp()
         export_file = os.path.join(temp_dir, f"{wafer_name}_defects.kfl")
         
         # 生成KFL文件（这里简单模拟）
-        with open(export_file, 'w') as f:
+        # 游标直接喂给csv.writer流式写出，不整表fetchall进内存
+        with open(export_file, 'w', newline='') as f:
             f.write(f"KFL Export for {wafer_name}\n")
-            f.write("defect_id,center_x,center_y,ai_adc_type,adc_type\n")
-            
-            for defect in defects:
-                f.write(f"{defect[0]},{defect[1]},{defect[2]},{defect[3]},{defect[4]}\n")
+            writer = csv.writer(f)
+            writer.writerow(['defect_id', 'center_x', 'center_y', 'ai_adc_type', 'adc_type'])
+            writer.writerows(inner_cursor)
+        inner_conn.close()
         
         return export_file, None
     
     def batch_export_kfl(self, wafer_ids):
         """批量导出多个晶圆的KFL文件"""
-        # 创建临时目录保存所有导出文件
+        # 创建临时目录保存ZIP包
         temp_dir = tempfile.mkdtemp()
-        export_files = []
-        
-        for wafer_id in wafer_ids:
-            export_file, error = self.export_wafer_kfl(wafer_id)
-            if error:
-                continue
-            
-            # 复制到临时目录
-            shutil.copy(export_file, os.path.join(temp_dir, os.path.basename(export_file)))
-            export_files.append(os.path.join(temp_dir, os.path.basename(export_file)))
+        zip_file = os.path.join(temp_dir, "batch_export.zip")
+        exported = 0
+        
+        # 导出文件直接写进ZIP，不再先复制一份到临时目录；
+        # KFL是文本，compresslevel=1已有足够压缩率且快得多
+        import zipfile
+        with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for wafer_id in wafer_ids:
+                export_file, error = self.export_wafer_kfl(wafer_id)
+                if error:
+                    continue
+                
+                zf.write(export_file, os.path.basename(export_file))
+                exported += 1
         
-        # 创建ZIP包
-        if export_files:
-            zip_file = os.path.join(temp_dir, "batch_export.zip")
-            import zipfile
-            with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-                for file in export_files:
-                    zf.write(file, os.path.basename(file))
-            
+        if exported:
             return zip_file, None
         
+        os.remove(zip_file)
         return None, "没有找到可导出的晶圆"
 
 # Web API接口层（用于前端调用）
@@ -744,13 +918,10 @@ class WebInterface:
     
     def get_wafer_data(self, wafer_id, defect_id=None):
         """获取晶圆缺陷数据"""
-        conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-        cursor = conn.cursor()
-        
-        # 获取晶圆信息
-        cursor.execute("SELECT folder_path, wafer_name FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
+        # 获取晶圆信息（线程本地长连接，不与管理器的写锁争抢）
+        cursor = _thread_conn().execute(
+            "SELECT folder_path, wafer_name FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
         result = cursor.fetchone()
-        conn.close()
         
         if not result:
             return {"success": False, "error": "晶圆不存在"}
@@ -759,54 +930,53 @@ class WebInterface:
         inner_db_path = os.path.join(folder_path, 'database.db')
         
         try:
-            inner_conn = sqlite3.connect(inner_db_path)
-            inner_conn.row_factory = sqlite3.Row  # 允许通过列名访问
-            inner_cursor = inner_conn.cursor()
-            
-            # 获取所有缺陷数据
-            inner_cursor.execute("SELECT * FROM defect_info")
-            defects = []
-            for row in inner_cursor.fetchall():
-                # 转换为前端需要的格式
-                defect = dict(row)
-                # 确保每个缺陷都有必要的字段
-                defect['id'] = defect.get('defect_id', f'defect_{len(defects)+1}')
-                defect['x'] = defect.get('center_x', '--')
-                defect['y'] = defect.get('center_y', '--')
-                # 映射AI预测类型
-                ai_type_map = {1: 'Particle', 2: 'Scratch', 3: 'Stain', 4: 'Pinhole', 5: 'Other'}
-                defect['ai_adc_type'] = ai_type_map.get(defect.get('ai_adc_type', 0), '--')
-                # 如果已经有手动标注，也映射
-                if defect.get('adc_type') and defect.get('adc_type') != defect.get('ai_adc_type'):
-                    defect['adc_type'] = ai_type_map.get(defect.get('adc_type', 0), '')
-                else:
-                    defect['adc_type'] = ''
-                # 获取标注次数，默认为0
-                defect['label_count'] = defect.get('label_count', 0)
-                defect['size'] = '--'
-                defect['intensity'] = '--'
-                defect['category'] = '--'
-                defect['severity'] = ''
-                defect['comment'] = ''
-                defects.append(defect)
-            
-            # 返回兼容前端的数据格式
-            return {
-                "success": True,
-                "data": defects,
-                "wafer": {
-                    "wafer_name": wafer_name,
-                    "folder_path": folder_path,
-                    "progress": 0,
-                    "label_status": 1
+            # contextlib.closing保证连接结构化关闭，不再在finally里
+            # 探测locals()判断变量是否存在。持有管理器锁读取，
+            # 避免撞上进度同步对内层库的删除重建
+            with self.manager._lock, \
+                 contextlib.closing(_open_db(inner_db_path)) as inner_conn:
+                inner_conn.row_factory = sqlite3.Row  # 允许通过列名访问
+                inner_cursor = inner_conn.cursor()
+                
+                # 获取所有缺陷数据。前端需要的别名列和常量默认值直接
+                # 在SELECT里给出，Python循环只剩类型名映射一件事
+                inner_cursor.execute('''
+                    SELECT defect_id, defect_id AS id,
+                           center_x, center_y, center_x AS x, center_y AS y,
+                           ai_adc_type, adc_type,
+                           COALESCE(label_count, 0) AS label_count,
+                           '--' AS size, '--' AS intensity, '--' AS category,
+                           '' AS severity, '' AS comment
+                    FROM defect_info
+                    ORDER BY rowid
+                ''')
+                defects = []
+                for row in inner_cursor.fetchall():
+                    # 转换为前端需要的格式
+                    defect = dict(row)
+                    # 映射AI预测类型
+                    defect['ai_adc_type'] = _ADC_TYPE_NAMES.get(defect['ai_adc_type'], '--')
+                    # 如果已经有手动标注，也映射
+                    if defect['adc_type'] and defect['adc_type'] != defect['ai_adc_type']:
+                        defect['adc_type'] = _ADC_TYPE_NAMES.get(defect['adc_type'], '')
+                    else:
+                        defect['adc_type'] = ''
+                    defects.append(defect)
+                
+                # 返回兼容前端的数据格式
+                return {
+                    "success": True,
+                    "data": defects,
+                    "wafer": {
+                        "wafer_name": wafer_name,
+                        "folder_path": folder_path,
+                        "progress": 0,
+                        "label_status": 1
+                    }
                 }
-            }
         except Exception as e:
-            print(f"获取晶圆数据失败: {str(e)}")
+            log.exception("获取晶圆数据失败")
             return {"success": False, "error": str(e)}
-        finally:
-            if 'inner_conn' in locals():
-                inner_conn.close()
     
     def save_label(self, wafer_id, defect_index, adc_type, severity=None, comment=None):
         """保存标注信息"""
@@ -815,163 +985,189 @@ class WebInterface:
             severity = ""
         if comment is None:
             comment = ""
-        print(f"保存标注: wafer_id={wafer_id}, defect_index={defect_index}, adc_type={adc_type}, severity={severity}")
+        log.debug("保存标注: wafer_id=%s, defect_index=%s, adc_type=%s, severity=%s",
+                  wafer_id, defect_index, adc_type, severity)
         
-        conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-        cursor = conn.cursor()
-        
-        # 获取晶圆信息
-        cursor.execute("SELECT folder_path FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
-        result = cursor.fetchone()
-        conn.close()
+        # 获取晶圆文件夹路径（带缓存，命中时不查库）
+        folder_path = _folder_path_for(wafer_id)
         
-        if not result:
+        if folder_path is None:
             return {"success": False, "error": "晶圆不存在"}
         
-        folder_path = result[0]
         inner_db_path = os.path.join(folder_path, 'database.db')
         
         try:
             # 转换adc_type为数字
-            type_map = {'Particle': 1, 'Scratch': 2, 'Stain': 3, 'Pinhole': 4, 'Other': 5}
-            adc_type_num = type_map.get(adc_type, 0)
-            
-            inner_conn = sqlite3.connect(inner_db_path)
-            inner_cursor = inner_conn.cursor()
+            adc_type_num = _ADC_TYPE_MAP.get(adc_type, 0)
             
-            try:
-                # 确保表中有severity和comment字段
-                inner_cursor.execute("PRAGMA table_info(defect_info)")
-                columns = [col[1] for col in inner_cursor.fetchall()]
-                
-                # 获取所有缺陷，找到对应索引的缺陷
-                inner_cursor.execute("SELECT defect_id FROM defect_info")
-                defect_ids = [row[0] for row in inner_cursor.fetchall()]
+            # 内层库会被进度同步整库删除重建，多线程服务下更新、
+            # 补列和同步必须与重建互斥，整段持有管理器锁
+            # （可重入锁，内部的sync_wafer_progress可再次获取）
+            with self.manager._lock:
+                inner_conn = _open_db(inner_db_path)
+                inner_cursor = inner_conn.cursor()
                 
-                if 0 <= defect_index < len(defect_ids):
-                    target_defect_id = defect_ids[defect_index]
-                    
-                    # 确保表中有必要的字段
-                    if 'severity' not in columns:
-                        inner_cursor.execute("ALTER TABLE defect_info ADD COLUMN severity TEXT")
-                    if 'comment' not in columns:
-                        inner_cursor.execute("ALTER TABLE defect_info ADD COLUMN comment TEXT")
-                    if 'label_time' not in columns:
-                        inner_cursor.execute("ALTER TABLE defect_info ADD COLUMN label_time TIMESTAMP")
-                    if 'label_count' not in columns:
-                        inner_cursor.execute("ALTER TABLE defect_info ADD COLUMN label_count INTEGER DEFAULT 0")
-                    inner_conn.commit()
+                try:
+                    # 标注字段在库创建/加载时已由_ensure_schema补齐，
+                    # 这里兜底处理加载顺序导致的遗漏
+                    _ensure_schema(inner_db_path)
                     
-                    # 更新缺陷标注，包括adc_type、severity、comment、时间戳和标注次数+1
-                    inner_cursor.execute(
-                        "UPDATE defect_info SET adc_type = ?, severity = ?, comment = ?, label_time = ?, label_count = label_count + 1 WHERE defect_id = ?",
-                        (adc_type_num, severity, comment, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), target_defect_id)
-                    )
-                    inner_conn.commit()
+                    # 更新缺陷标注，包括adc_type、severity、comment、时间戳和
+                    # 标注次数+1，整个保存就是一条UPDATE一次提交。按索引定位
+                    # 交给子查询完成，不再把全部defect_id读进Python按下标取值。
+                    # 排序必须与get_wafer_data返回列表的顺序一致，两边都按
+                    # rowid（即导入顺序）；索引越界时子查询为NULL，UPDATE
+                    # 不会命中任何行
+                    with inner_conn:
+                        inner_cursor.execute(
+                            "UPDATE defect_info SET adc_type = ?, severity = ?, comment = ?, label_time = ?, label_count = label_count + 1 "
+                            "WHERE defect_id = (SELECT defect_id FROM defect_info ORDER BY rowid LIMIT 1 OFFSET ?)",
+                            (adc_type_num, severity, comment, int(time.time()), defect_index)
+                        )
                     
-                    print(f"标注保存成功: {wafer_id}, defect_id={target_defect_id}, severity={severity}")
-            finally:
-                # 确保数据库连接关闭
-                if inner_conn:
+                    if inner_cursor.rowcount:
+                        log.debug("标注保存成功: %s, defect_index=%s, severity=%s",
+                                  wafer_id, defect_index, severity)
+                finally:
+                    # 确保数据库连接关闭
                     inner_conn.close()
-            
-            # 保存成功后，同步晶圆进度
-            self.manager.sync_wafer_progress(wafer_id)
-            print(f"已同步晶圆进度: {wafer_id}")
+                
+                # 保存成功后，同步晶圆进度
+                self.manager.sync_wafer_progress(wafer_id)
+            log.debug("已同步晶圆进度: %s", wafer_id)
             
             return {"success": True, "message": "标注保存成功"}
         except Exception as e:
-            print(f"保存标注失败: {str(e)}")
+            log.exception("保存标注失败")
             return {"success": False, "error": str(e)}
     
-    def handle_request(self, action, params):
-        """处理前端请求"""
-        if action == "load_folders":
-            root_dir = params.get("root_dir")
-            recursive = params.get("recursive", True)
-            
-            # 修复路径问题：如果前端只传递了文件夹名称，在当前工作目录下查找
-            if root_dir and not os.path.isabs(root_dir):
-                # 检查是否是当前目录下的子文件夹
-                if os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), root_dir)):
-                    root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), root_dir)
-                else:
-                    # 默认为当前目录
-                    root_dir = os.path.dirname(os.path.abspath(__file__))
-                    
-            result = self.manager.load_wafer_folders(root_dir, recursive)
-            
-            # 加载完成后，重新获取更新后的晶圆列表
-            wafers = self.manager.get_wafer_list()
-            return {
-                "success": True,
-                "result": result,
-                "wafers": wafers
-            }
-        
-        elif action == "get_wafer_list":
-            wafers = self.manager.get_wafer_list()
-            # 确保返回的数据格式与前端预期一致
-            return wafers
-            
-        elif action == "get_wafer_data":
-            wafer_id = params.get("wafer_id")
-            return self.get_wafer_data(wafer_id)
-            
-        elif action == "save_label":
-            wafer_id = params.get("wafer_id")
-            defect_index = params.get("defect_index")
-            adc_type = params.get("adc_type")
-            severity = params.get("severity", "")  # 允许空的severity值
-            comment = params.get("comment", "")  # 允许空的comment值
-            return self.save_label(wafer_id, defect_index, adc_type, severity, comment)
-        
-        elif action == "sync_progress":
-            wafer_id = params.get("wafer_id")
-            return {"success": self.manager.sync_wafer_progress(wafer_id)}
-        
-        elif action == "export_kfl":
-            wafer_id = params.get("wafer_id")
-            export_all = params.get("export_all", False)
-            file_path, error = self.manager.export_wafer_kfl(wafer_id, export_all)
-            if error:
-                return {"success": False, "error": error}
-            return {"success": True, "file_path": file_path}
-        
-        elif action == "batch_export_kfl":
-            wafer_ids = params.get("wafer_ids", [])
-            file_path, error = self.manager.batch_export_kfl(wafer_ids)
-            if error:
-                return {"success": False, "error": error}
-            return {"success": True, "file_path": file_path}
-        
-        elif action == "reset_wafer_status":
-            wafer_id = params.get("wafer_id")
-            success = self.manager.reset_wafer_status(wafer_id)
-            return {"success": success}
-        
-        elif action == "enter_inner_layer":
-            wafer_id = params.get("wafer_id")
-            success, error = self.manager.enter_inner_layer(wafer_id)
-            result = {"success": success, "error": error}
-            if success:
-                result["redirect_url"] = f"/inner_labeling.html?wafer_id={wafer_id}"
-            return result
-
+    def _action_load_folders(self, params):
+        root_dir = params.get("root_dir")
+        recursive = params.get("recursive", True)
+        
+        # 修复路径问题：如果前端只传递了文件夹名称，在当前工作目录下查找
+        if root_dir and not os.path.isabs(root_dir):
+            # 检查是否是当前目录下的子文件夹
+            if os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), root_dir)):
+                root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), root_dir)
+            else:
+                # 默认为当前目录
+                root_dir = os.path.dirname(os.path.abspath(__file__))
+                
+        result = self.manager.load_wafer_folders(root_dir, recursive)
         
-        else:
+        # 加载完成后，重新获取更新后的晶圆列表
+        wafers = self.manager.get_wafer_list()
+        return {
+            "success": True,
+            "result": result,
+            "wafers": wafers
+        }
+    
+    def _action_get_wafer_list(self, params):
+        # 确保返回的数据格式与前端预期一致
+        return self.manager.get_wafer_list()
+    
+    def _action_get_wafer_data(self, params):
+        return self.get_wafer_data(params.get("wafer_id"))
+    
+    def _action_save_label(self, params):
+        wafer_id = params.get("wafer_id")
+        defect_index = params.get("defect_index")
+        adc_type = params.get("adc_type")
+        severity = params.get("severity", "")  # 允许空的severity值
+        comment = params.get("comment", "")  # 允许空的comment值
+        return self.save_label(wafer_id, defect_index, adc_type, severity, comment)
+    
+    def _action_sync_progress(self, params):
+        return {"success": self.manager.sync_wafer_progress(params.get("wafer_id"))}
+    
+    def _action_export_kfl(self, params):
+        wafer_id = params.get("wafer_id")
+        export_all = params.get("export_all", False)
+        file_path, error = self.manager.export_wafer_kfl(wafer_id, export_all)
+        if error:
+            return {"success": False, "error": error}
+        return {"success": True, "file_path": file_path}
+    
+    def _action_batch_export_kfl(self, params):
+        wafer_ids = params.get("wafer_ids", [])
+        file_path, error = self.manager.batch_export_kfl(wafer_ids)
+        if error:
+            return {"success": False, "error": error}
+        return {"success": True, "file_path": file_path}
+    
+    def _action_reset_wafer_status(self, params):
+        return {"success": self.manager.reset_wafer_status(params.get("wafer_id"))}
+    
+    def _action_enter_inner_layer(self, params):
+        wafer_id = params.get("wafer_id")
+        success, error = self.manager.enter_inner_layer(wafer_id)
+        result = {"success": success, "error": error}
+        if success:
+            result["redirect_url"] = f"/inner_labeling.html?wafer_id={wafer_id}"
+        return result
+    
+    # action名到处理方法的分发表
+    _actions = {
+        "load_folders": _action_load_folders,
+        "get_wafer_list": _action_get_wafer_list,
+        "get_wafer_data": _action_get_wafer_data,
+        "save_label": _action_save_label,
+        "sync_progress": _action_sync_progress,
+        "export_kfl": _action_export_kfl,
+        "batch_export_kfl": _action_batch_export_kfl,
+        "reset_wafer_status": _action_reset_wafer_status,
+        "enter_inner_layer": _action_enter_inner_layer,
+    }
+    
+    def handle_request(self, action, params):
+        """处理前端请求：按action名在分发表中查处理方法，
+        O(1)字典查找替代逐个字符串比较的if/elif链"""
+        handler = self._actions.get(action)
+        if handler is None:
             return {"success": False, "error": "未知的操作"}
+        return handler(self, params)
 
 # 简单的服务器实现，用于演示
 if __name__ == "__main__":
     import http.server
-    import socketserver
     import json
-    from urllib.parse import parse_qs
+    import mimetypes
     
     web_interface = WebInterface()
     
+    # 前端静态资源运行期不会变化，启动时一次性读进内存：
+    # URL路径 -> (字节内容, Content-Type)，请求时零磁盘访问
+    _STATIC = {}
+    _script_dir = os.path.dirname(os.path.abspath(__file__))
+    for _name in os.listdir(_script_dir):
+        if _name.endswith((".html", ".js", ".css")):
+            with open(os.path.join(_script_dir, _name), "rb") as _f:
+                _STATIC["/" + _name] = (
+                    _f.read(),
+                    mimetypes.guess_type(_name)[0] or "application/octet-stream")
+    
     class Handler(http.server.BaseHTTPRequestHandler):
+        def _send_bytes(self, data, content_type):
+            """发送内存中的静态资源"""
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def _send_file(self, file_path, content_type):
+            """流式发送文件：带Content-Length响应头，64KiB一块
+            拷贝到socket，不把整个文件读成一个bytes对象"""
+            size = os.path.getsize(file_path)
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            with open(file_path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile, 65536)
+        
         def do_GET(self):
             # 忽略Vite客户端请求
             if "@vite/client" in self.path:
@@ -986,13 +1182,9 @@ if __name__ == "__main__":
             
             # 特殊处理内层标注页面（带查询参数）
             if self.path.startswith("/inner_labeling.html"):
-                file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inner_labeling.html")
-                if os.path.exists(file_path):
-                    self.send_response(200)
-                    self.send_header("Content-Type", "text/html")
-                    self.end_headers()
-                    with open(file_path, "rb") as f:
-                        self.wfile.write(f.read())
+                asset = _STATIC.get("/inner_labeling.html")
+                if asset is not None:
+                    self._send_bytes(*asset)
                 else:
                     self.send_response(404)
                     self.end_headers()
@@ -1011,61 +1203,42 @@ if __name__ == "__main__":
                     self.send_header("Access-Control-Allow-Origin", "*")
                     self.end_headers()
                     
-                    # 解析请求路径和参数
+                    # 解析请求路径和参数。parse_qsl直接产出键值对，
+                    # 省掉parse_qs的列表包装和随后的解包循环
                     parts = self.path.split("?")
                     api_path = parts[0].replace("/api/", "")
-                    params = {}
-                    
-                    if len(parts) > 1:
-                        params = parse_qs(parts[1])
-                        # 将参数从列表转换为单个值
-                        for key in params:
-                            params[key] = params[key][0]
+                    params = dict(parse_qsl(parts[1])) if len(parts) > 1 else {}
                     
                     # 处理API请求
                     result = web_interface.handle_request(api_path, params)
-                    self.wfile.write(json.dumps(result).encode())
+                    self.wfile.write(_json_dumps(result))
                 else:
-                    # 静态文件服务
+                    # 静态文件服务：预加载的资源直接从内存发出
                     file_path = self.path[1:]  # 去掉前导斜杠
                     if not file_path:
                         file_path = "frontend.html"
                     
-                    # 确保文件存在
+                    asset = _STATIC.get("/" + file_path)
+                    if asset is not None:
+                        self._send_bytes(*asset)
+                        return
+                    
+                    # 未预加载的文件退回磁盘读取
                     if not os.path.exists(file_path):
-                        # 特殊处理内层标注页面
-                        if file_path == "inner_labeling.html":
-                            # 尝试在当前目录查找内层标注页面
-                            inner_labeling_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inner_labeling.html")
-                            if os.path.exists(inner_labeling_path):
-                                with open(inner_labeling_path, "rb") as f:
-                                    self.send_response(200)
-                                    self.send_header("Content-Type", "text/html")
-                                    self.end_headers()
-                                    self.wfile.write(f.read())
-                                return
-                        
                         self.send_response(404)
                         self.end_headers()
                         self.wfile.write(b"File not found")
                         return
                     
-                    with open(file_path, "rb") as f:
-                        self.send_response(200)
-                        if file_path.endswith(".html"):
-                            self.send_header("Content-Type", "text/html")
-                        elif file_path.endswith(".js"):
-                            self.send_header("Content-Type", "application/javascript")
-                        elif file_path.endswith(".css"):
-                            self.send_header("Content-Type", "text/css")
-                        self.end_headers()
-                        self.wfile.write(f.read())
+                    content_type = (mimetypes.guess_type(file_path)[0]
+                                    or "application/octet-stream")
+                    self._send_file(file_path, content_type)
             except Exception as e:
                 self.send_response(500)
                 self.send_header("Content-Type", "text/plain")
                 self.end_headers()
                 self.wfile.write(f"Error: {str(e)}".encode())
-                print(f"Server error: {str(e)}")
+                log.error("Server error: %s", e)
                 
         def do_POST(self):
             # 处理POST请求
@@ -1073,7 +1246,7 @@ if __name__ == "__main__":
             post_data = self.rfile.read(content_length)
             
             try:
-                data = json.loads(post_data)
+                data = _json_loads(post_data)
                 action = data.get("action")
                 params = data.get("params", {})
                 
@@ -1085,27 +1258,20 @@ if __name__ == "__main__":
                 self.send_header("Content-Type", "application/json")
                 self.send_header("Access-Control-Allow-Origin", "*")
                 self.end_headers()
-                self.wfile.write(json.dumps(result).encode())
+                self.wfile.write(_json_dumps(result))
             except Exception as e:
                 self.send_response(500)
                 self.send_header("Content-Type", "application/json")
                 self.send_header("Access-Control-Allow-Origin", "*")
                 self.end_headers()
                 error_response = {"success": False, "error": str(e)}
-                self.wfile.write(json.dumps(error_response).encode())
-                print(f"API错误: {str(e)}")
+                self.wfile.write(_json_dumps(error_response))
+                log.error("API错误: %s", e)
                 
         def _handle_image_request(self):
             # 解析请求参数
             parts = self.path.split("?")
-            params = {}
-            
-            if len(parts) > 1:
-                from urllib.parse import parse_qs
-                params = parse_qs(parts[1])
-                # 将参数从列表转换为单个值
-                for key in params:
-                    params[key] = params[key][0]
+            params = dict(parse_qsl(parts[1])) if len(parts) > 1 else {}
             
             wafer_id = params.get('wafer_id')
             image_path = params.get('image_path')
@@ -1117,38 +1283,46 @@ if __name__ == "__main__":
                 return
             
             try:
-                # 获取晶圆信息
-                conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute("SELECT folder_path FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
-                result = cursor.fetchone()
-                conn.close()
+                # 获取晶圆文件夹路径（带缓存，命中时不查库）
+                folder_path = _folder_path_for(wafer_id)
                 
-                if not result:
+                if folder_path is None:
                     self.send_response(404)
                     self.end_headers()
                     self.wfile.write("Wafer not found".encode())
                     return
                 
-                folder_path = result[0]
                 full_image_path = os.path.join(folder_path, image_path)
                 
-                if os.path.exists(full_image_path):
-                    self.send_response(200)
-                    # 设置正确的Content-Type
-                    if full_image_path.endswith(".jpg") or full_image_path.endswith(".jpeg"):
-                        self.send_header("Content-Type", "image/jpeg")
-                    elif full_image_path.endswith(".png"):
-                        self.send_header("Content-Type", "image/png")
-                    else:
-                        self.send_header("Content-Type", "application/octet-stream")
-                    self.end_headers()
-                    with open(full_image_path, "rb") as f:
-                        self.wfile.write(f.read())
-                else:
+                try:
+                    mtime = os.stat(full_image_path).st_mtime_ns
+                except OSError:
                     self.send_response(404)
                     self.end_headers()
                     self.wfile.write("Image file not found".encode())
+                    return
+                
+                # 设置正确的Content-Type
+                if full_image_path.endswith(".jpg") or full_image_path.endswith(".jpeg"):
+                    content_type = "image/jpeg"
+                elif full_image_path.endswith(".png"):
+                    content_type = "image/png"
+                else:
+                    content_type = "application/octet-stream"
+                
+                # 热点图片直接走内存缓存，未命中时读盘并填充
+                cache_key = f"{wafer_id}|{image_path}"
+                data = _image_cache.get(cache_key, mtime)
+                if data is None:
+                    with open(full_image_path, "rb") as f:
+                        data = f.read()
+                    _image_cache.put(cache_key, mtime, data)
+                
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
             except Exception as e:
                 self.send_response(500)
                 self.end_headers()
@@ -1161,13 +1335,9 @@ if __name__ == "__main__":
 # 为了兼容可能的旧调用方式，保留这个方法
 def save_label_compat(self, wafer_id, defect_id, label_data):
     """保存缺陷标注数据"""
-    conn = sqlite3.connect(GLOBAL_INDEX_DB_PATH)
-    cursor = conn.cursor()
-    
-    # 获取晶圆信息
-    cursor.execute("SELECT folder_path FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
+    # 获取晶圆信息（线程本地长连接）
+    cursor = _thread_conn().execute("SELECT folder_path FROM wafer_metadata WHERE wafer_id = ?", (wafer_id,))
     result = cursor.fetchone()
-    conn.close()
     
     if not result:
         return {"success": False, "error": "晶圆不存在"}
@@ -1176,43 +1346,34 @@ def save_label_compat(self, wafer_id, defect_id, label_data):
     inner_db_path = os.path.join(folder_path, 'database.db')
     
     try:
-        inner_conn = sqlite3.connect(inner_db_path)
-        inner_cursor = inner_conn.cursor()
-        
-        # 检查defect_info表是否有label列
-        inner_cursor.execute("PRAGMA table_info(defect_info)")
-        columns = [row[1] for row in inner_cursor.fetchall()]
-        
-        if 'label' not in columns:
-            # 添加label列
-            inner_cursor.execute("ALTER TABLE defect_info ADD COLUMN label TEXT")
-        if 'label_time' not in columns:
-            inner_cursor.execute("ALTER TABLE defect_info ADD COLUMN label_time TIMESTAMP")
-        if 'is_labeled' not in columns:
-            inner_cursor.execute("ALTER TABLE defect_info ADD COLUMN is_labeled INTEGER DEFAULT 0")
-        
-        # 保存标注数据（暂时更新所有记录，因为没有id列）
-        inner_cursor.execute('''
-            UPDATE defect_info 
-            SET label = ?, label_time = ?, is_labeled = 1
-        ''', (json.dumps(label_data), datetime.now()))
-        
-        inner_conn.commit()
-        inner_conn.close()
-        
-        # 更新全局索引库中的进度信息
-        self.manager.sync_wafer_progress(wafer_id)
+        # 内层库的更新与进度同步的删除重建互斥（见save_label）
+        with self.manager._lock:
+            # 标注字段统一由_ensure_schema补齐
+            _ensure_schema(inner_db_path)
+            
+            # closing保证关闭，with inner_conn保证提交/回滚，
+            # 不再在except里探测locals()
+            with contextlib.closing(_open_db(inner_db_path)) as inner_conn:
+                with inner_conn:
+                    # 保存标注数据（暂时更新所有记录，因为没有id列）
+                    inner_conn.execute('''
+                        UPDATE defect_info 
+                        SET label = ?, label_time = ?, is_labeled = 1
+                    ''', (json.dumps(label_data), int(time.time())))
+            
+            # 更新全局索引库中的进度信息
+            self.manager.sync_wafer_progress(wafer_id)
         
         return {"success": True, "message": "标注保存成功"}
     except Exception as e:
-        print(f"保存标注失败: {str(e)}")
-        if 'inner_conn' in locals():
-            inner_conn.rollback()
-            inner_conn.close()
+        log.error("保存标注失败: %s", e)
         return {"success": False, "error": str(e)}
 
-# 启动服务器
-PORT = 8002
-with socketserver.TCPServer(("", PORT), Handler) as httpd:
-    print(f"服务器已启动，访问 http://localhost:{PORT}")
-    httpd.serve_forever()
\ No newline at end of file
+# 启动服务器。ThreadingHTTPServer给每个请求独立线程：一个线程在
+# 保存标注时，其他线程仍能响应图片和静态请求，WAL的读写并发才
+# 真正发挥作用。启动代码放在__main__保护内，模块可被安全import
+if __name__ == "__main__":
+    PORT = 8002
+    with http.server.ThreadingHTTPServer(("", PORT), Handler) as httpd:
+        print(f"服务器已启动，访问 http://localhost:{PORT}")
+        httpd.serve_forever()
\ No newline at end of file